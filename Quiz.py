@@ -9,15 +9,38 @@ Requisitos finales
   encabezado se omite por completo.
 """
 
+import concurrent.futures
+import hashlib
+import io
 import json
+import queue
 import random
 import re
+import threading
+import string
 import tkinter as tk
-from tkinter import scrolledtext
+from tkinter import font as tkfont, scrolledtext
 from pathlib import Path
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dataclasses import dataclass
-from typing import List, Dict, Tuple
+from functools import lru_cache
+from typing import List, Dict, Optional, Tuple
+
+try:  # orjson es opcional: parsea bytes directamente y es más rápido
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+@lru_cache(maxsize=8)
+def _load_json(path_str: str, mtime_ns: int) -> Dict:
+    # `mtime_ns` forma parte de la clave: si el archivo cambia se vuelve a parsear.
+    return _json_loads(Path(path_str).read_bytes())
+
+def _read_json(path: Path) -> Dict:
+    return _load_json(str(path), path.stat().st_mtime_ns)
 
 # ───────────── Config & Data Models ──────────────
 @dataclass
@@ -30,7 +53,7 @@ class LLMConfig:
 
     @classmethod
     def from_file(cls, path: Path = Path("llm_config.json")) -> "LLMConfig":
-        data = json.loads(path.read_text(encoding="utf-8"))
+        data = dict(_read_json(path))  # copia: el dict cacheado se comparte
         data.setdefault("timeout", cls.timeout)
         return cls(**data)
 
@@ -43,7 +66,7 @@ class PromptTemplates:
 
     @classmethod
     def from_file(cls, path: Path = Path("prompts.json")) -> "PromptTemplates":
-        data: Dict = json.loads(path.read_text(encoding="utf-8"))
+        data: Dict = _read_json(path)
         return cls(
             system=data["system_prompt"],
             all_correct=data["user_prompts"]["all_correct"],
@@ -56,6 +79,77 @@ class Question:
     statement: str
     answer: str
 
+# ───────────── Patrones de limpieza ──────────────
+# Los bloques <think> se quitan en una pasada previa: así `^` vuelve a coincidir
+# justo después de ellos y no quedan atrapados dentro de otros delimitadores.
+_RE_THINK = re.compile(r"<think>.*?</think>", re.I | re.S)
+# El resto es una sola alternación compilada: la respuesta se recorre una vez y el
+# grupo que coincide decide si el fragmento se descarta o se conserva su interior.
+# Cambio aceptado respecto de la limpieza secuencial anterior (una pasada por
+# patrón): en una sola pasada gana la coincidencia que empieza antes y el texto
+# ya sustituido no se vuelve a examinar. Por eso difiere en entradas poco
+# habituales: delimitadores LaTeX anidados o solapados ("$$\(x\)$$",
+# "\[\[x\]\]"), líneas "Thought…" o encabezados dentro de un bloque LaTeX, o
+# una línea "Thought…" que queda al inicio tras borrar un encabezado ("#\nThought").
+_RE_CLEAN = re.compile(
+    r"(?P<thought>^\s*(?:thought|razonamiento|assistant reasoning)[^\n]*)"
+    r"|(?P<head>^#+\s*)"                                                # encabezados Markdown
+    r"|\\\((?P<li>.*?)\\\)"                                             # \( … \)
+    r"|\\\[(?P<lb>.*?)\\\]"                                             # \[ … ]
+    r"|\$\$(?P<dd>.*?)\$\$",                                            # $$ … $$
+    re.I | re.S | re.M,
+)
+# Los paréntesis triviales van en una pasada aparte sobre el resultado: así también
+# se quitan los que quedan al eliminar un delimitador, como en "(\(x\))" -> "x".
+_RE_TRIV_PAREN = re.compile(r"\((\w)\)")
+_RE_EXP = re.compile(r"\^([0-9]+)")
+_SUPER_MAP = str.maketrans("0123456789", "⁰¹²³⁴⁵⁶⁷⁸⁹")
+# Si el texto (en minúsculas) no contiene ninguno de estos, la limpieza no cambia nada.
+# "(" cubre tanto \( … \) como los paréntesis triviales.
+_MARKERS = ("<think>", "(", "\\[", "$$", "^", "#", "thought", "razonamiento", "assistant reasoning")
+_DROP_GROUPS = frozenset({"thought", "head"})
+
+# Normalización de respuestas: minúsculas ASCII y sin espacios en una sola llamada.
+_LOWER_NOSPACE_TABLE = str.maketrans(
+    {**{c: c.lower() for c in string.ascii_uppercase}, " ": None}
+)
+
+
+def _clean_match(m: "re.Match[str]") -> str:
+    g = m.lastgroup
+    return "" if g in _DROP_GROUPS else m.group(g)
+
+def _split_visible(pending: str, in_think: bool) -> Tuple[str, str, bool]:
+    """Separa de un fragmento en streaming el texto que puede mostrarse.
+
+    Devuelve (visible, resto, in_think): `visible` excluye lo que está dentro de
+    <think>…</think>; `resto` es lo que aún no puede decidirse (p. ej. una
+    etiqueta cortada entre dos fragmentos) y debe anteponerse al siguiente.
+    """
+    low = pending.lower()
+    out = []
+    pos = 0
+    while True:
+        if in_think:
+            end = low.find("</think>", pos)
+            if end < 0:
+                return "".join(out), pending[max(pos, len(pending) - 7):], True
+            pos = end + 8
+            in_think = False
+        else:
+            start = low.find("<think>", pos)
+            if start < 0:
+                # Retiene un posible "<think" incompleto al final del fragmento.
+                cut = len(pending)
+                lt = low.rfind("<", max(pos, len(pending) - 6))
+                if lt >= 0 and "<think>".startswith(low[lt:]):
+                    cut = lt
+                out.append(pending[pos:cut])
+                return "".join(out), pending[cut:], False
+            out.append(pending[pos:start])
+            pos = start + 7
+            in_think = True
+
 # ───────────── Helpers ──────────────
 
 def load_questions(path: Path = Path("preguntas.json")) -> Tuple[str, List[Question]]:
@@ -64,126 +158,259 @@ def load_questions(path: Path = Path("preguntas.json")) -> Tuple[str, List[Quest
     * Si el JSON trae la clave "titulo", se devuelve ese texto.
     * Si no existe, se devuelve la cadena vacía "".
     """
-    data = json.loads(path.read_text(encoding="utf-8"))
+    data = _read_json(path)
     titulo = data.get("titulo", "")  # cadena vacía por defecto
     preguntas = [Question(q["pregunta"], q["respuesta"]) for q in data["preguntas"]]
     return titulo, preguntas
 
+def _pick_k(seq: List[Question], k: int) -> List[Question]:
+    """Elige `k` elementos distintos al azar sin recorrer todo el banco.
+
+    Pensado para `k` pequeño frente a `len(seq)`: cuesta O(k) en tiempo y memoria.
+    """
+    n = len(seq)
+    if k > n:
+        return list(seq)
+    idxs: Dict[int, None] = {}  # conserva el orden de extracción
+    while len(idxs) < k:
+        idxs[random.randrange(n)] = None
+    return [seq[i] for i in idxs]
+
 # ───────────── Main Application ──────────────
 class MathTutorApp:
     def __init__(self, questions: List[Question], llm_cfg: LLMConfig, prompts: PromptTemplates, title: str, n: int = 2):
-        self.questions = random.sample(questions, n) if n <= len(questions) else questions
+        self.questions = _pick_k(questions, n)
         self.cfg = llm_cfg
         self.prompts = prompts
         self.title_text = title.strip()
+        # Cuerpo de la petición al LLM: solo cambia el mensaje del usuario entre consultas.
+        self._payload_tpl = {
+            "model": self.cfg.model,
+            "messages": [{"role": "system", "content": self.prompts.system}, {"role": "user", "content": ""}],
+            "temperature": self.cfg.temperature,
+            "max_tokens": self.cfg.max_tokens,
+            "stream": True,
+        }
+        # Las respuestas correctas no cambian: se normalizan una sola vez.
+        self._norm_correct = [self._norm(q.answer) for q in self.questions]
+        # Última respuesta comprobada por pregunta: índice -> (texto, normalizado).
+        self._norm_user: Dict[int, Tuple[str, Tuple[str, ...]]] = {}
 
         self.entries: List[tk.Entry] = []
         self.labels: List[tk.Label] = []
 
+        # Las consultas al LLM corren en un hilo daemon fuera del hilo de Tk para no
+        # congelar la UI ni impedir que el proceso termine al cerrar la ventana.
+        self._llm_future: Optional[concurrent.futures.Future] = None
+        self._cancel = threading.Event()
+        # Fragmentos de texto que el hilo del LLM va recibiendo en streaming.
+        self._chunks: "queue.Queue[str]" = queue.Queue()
+
+        # Sesión HTTP reutilizable: una sola conexión (y handshake TLS) para todas las consultas.
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=4,
+            # read=0: un timeout de lectura no reenvía el POST (el LLM ya está generando).
+            max_retries=Retry(total=2, connect=2, read=0, backoff_factor=0.5, status_forcelist=(502, 503, 504), allowed_methods=frozenset({"POST"})),
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+        # Respuestas ya obtenidas, por hash de (modelo, temperatura, prompts).
+        self._reply_cache: Dict[str, str] = {}
+
         self.root = tk.Tk()
         self.root.title("Tutor de Algebra")
+        # Fuentes compartidas por todos los widgets (requieren que exista la raíz Tk).
+        self._font12 = tkfont.Font(family="Arial", size=12)
+        self._font_bold14 = tkfont.Font(family="Arial", size=14, weight="bold")
+        self._font11 = tkfont.Font(family="Arial", size=11)
         self._build_ui()
 
     # ---------- GUI BUILDERS ----------
     def _build_ui(self):
         # Mostrar encabezado solo si se proporcionó un título en el JSON
         if self.title_text:
-            tk.Label(self.root, text=self.title_text, font=("Arial", 14, "bold")).pack(pady=10)
+            tk.Label(self.root, text=self.title_text, font=self._font_bold14).pack(pady=10)
 
+        # Alias locales para el bucle (una fila de widgets por pregunta)
+        Frame, Label, Entry, Button = tk.Frame, tk.Label, tk.Entry, tk.Button
+        root, check, font12 = self.root, self._check_answer, self._font12
+        add_entry, add_label = self.entries.append, self.labels.append
         for idx, q in enumerate(self.questions, start=1):
-            frame = tk.Frame(self.root)
+            frame = Frame(root)
             frame.pack(fill="x", padx=10, pady=5)
-            tk.Label(frame, text=f"{idx}. {q.statement}", font=("Arial", 12)).pack(side="left")
-            ent = tk.Entry(frame, width=25, font=("Arial", 12))
+            Label(frame, text=f"{idx}. {q.statement}", font=font12).pack(side="left")
+            ent = Entry(frame, width=25, font=font12)
             ent.pack(side="left", padx=5)
-            tk.Button(frame, text="Enviar", font=("Arial", 12), bg="#4CAF50", fg="white", command=lambda i=idx-1: self._check_answer(i)).pack(side="left", padx=5)
-            lbl = tk.Label(frame, font=("Arial", 12))
+            Button(frame, text="Enviar", font=font12, bg="#4CAF50", fg="white", command=lambda i=idx-1: check(i)).pack(side="left", padx=5)
+            lbl = Label(frame, font=font12)
             lbl.pack(side="left", padx=5)
-            self.entries.append(ent)
-            self.labels.append(lbl)
+            add_entry(ent)
+            add_label(lbl)
 
-        self.tutor_btn = tk.Button(self.root, text="Retroalimentación del tutor", command=self._tutor_feedback, state="disabled", font=("Arial", 12), bg="#3F51B5", fg="white")
+        self.tutor_btn = tk.Button(self.root, text="Retroalimentación del tutor", command=self._tutor_feedback, state="disabled", font=self._font12, bg="#3F51B5", fg="white")
         self.tutor_btn.pack(pady=10)
-        self.feedback = scrolledtext.ScrolledText(self.root, width=85, height=12, font=("Arial", 11), wrap=tk.WORD, state="disabled")
+        self.feedback = scrolledtext.ScrolledText(self.root, width=85, height=12, font=self._font11, wrap=tk.WORD, state="disabled")
         self.feedback.pack(padx=10, pady=5)
 
     # ---------- CORE LOGIC ----------
     @staticmethod
-    def _norm(txt: str) -> str:
-        expr = txt.lower().replace(" ", "").strip().replace(")(", ")*(")
+    def _norm(txt: str) -> Tuple[str, ...]:
+        # Clave canónica para comparar: factores ordenados (se respeta la multiplicidad).
+        expr = txt.translate(_LOWER_NOSPACE_TABLE).strip().replace(")(", ")*(")
         if "*" not in expr:
-            return expr.strip("()")
-        factors = sorted(f.strip("()") for f in expr.split("*") if f)
-        return "*".join(factors)
+            return (expr.strip("()"),)
+        return tuple(sorted(f.strip("()") for f in expr.split("*") if f))
 
     @staticmethod
     def _strip_hidden_thoughts(text: str) -> str:
-        import re
-
-        cleaned = re.sub(r"<think>.*?</think>", "", text, flags=re.I | re.S)
-        cleaned = re.sub(r"(?m)^\s*(thought|razonamiento|assistant reasoning).*", "", cleaned, flags=re.I)
-        cleaned = re.sub(r"(?m)^#+\s*", "", cleaned)
-        # ① Elimina delimitadores LaTeX  (\…\)  y  [ … ]
-        latex_inline = re.compile(r"\\\((.*?)\\\)", flags=re.S)          # \( … \)
-        latex_block  = re.compile(r"\\\[([\s\S]*?)\\\]", flags=re.S)     # \[ … ]
-        cleaned = latex_inline.sub(r"\1", cleaned)
-        cleaned = latex_block.sub(r"\1", cleaned)
-
-        # --- elimina LaTeX ---
-        cleaned = re.sub(r"\\\((.*?)\\\)", r"\1", cleaned, flags=re.S)        # \( … \)
-        cleaned = re.sub(r"\\\[([\s\S]*?)\\\]", r"\1", cleaned, flags=re.S)   # \[ … ]
-        cleaned = re.sub(r"\$\$([\s\S]*?)\$\$", r"\1", cleaned, flags=re.S)   # $$ … $$
+        low = text.lower()
+        if not any(m in low for m in _MARKERS):
+            return text.strip()
+        cleaned = _RE_THINK.sub("", text)
+        cleaned = _RE_CLEAN.sub(_clean_match, cleaned)
 
         # --- quita paréntesis triviales ---
-        cleaned = re.sub(r"\((\w)\)", r"\1", cleaned)
+        cleaned = _RE_TRIV_PAREN.sub(r"\1", cleaned)
 
         # --- convierte exponentes a superíndice Unicode ---
-        super_map = str.maketrans("0123456789", "⁰¹²³⁴⁵⁶⁷⁸⁹")
-        cleaned = re.sub(
-            r"\^([0-9]+)",
-            lambda m: ''.join(ch.translate(super_map) for ch in m.group(1)),
-            cleaned
-        )
+        cleaned = _RE_EXP.sub(lambda m: m.group(1).translate(_SUPER_MAP), cleaned)
 
         return cleaned.replace("#", "").strip()
 
     def _check_answer(self, idx: int):
         user = self.entries[idx].get()
-        correct = self.questions[idx].answer
-        ok = self._norm(user) == self._norm(correct)
+        user_norm = self._norm(user)
+        self._norm_user[idx] = (user, user_norm)
+        ok = user_norm == self._norm_correct[idx]
         self.labels[idx].config(text="Correcto" if ok else "Incorrecto", fg="green" if ok else "red")
         if ok:
             self.entries[idx].config(state="disabled")
-        self.tutor_btn.config(state="normal")
+        if self._llm_future is None:
+            self.tutor_btn.config(state="normal")
 
     def _gather_wrong_answers(self):
-        return [(i, ent.get()) for i, ent in enumerate(self.entries) if self._norm(ent.get()) != self._norm(self.questions[i].answer)]
+        norm, correct, seen = self._norm, self._norm_correct, self._norm_user.get
+        wrong = []
+        add = wrong.append
+        for i, ent in enumerate(self.entries):
+            user = ent.get()
+            # Reutiliza la normalización de _check_answer si el texto no cambió desde entonces.
+            cached = seen(i)
+            user_norm = cached[1] if cached is not None and cached[0] == user else norm(user)
+            if user_norm != correct[i]:
+                add((i, user))
+        return wrong
+
+    def _format_details(self, wrongs: List[Tuple[int, str]]) -> str:
+        qs = self.questions
+        parts = [f"Pregunta: {qs[i].statement}\nRespuesta del estudiante: {ans}\nRespuesta correcta: {qs[i].answer}" for i, ans in wrongs]
+        return "\n\n".join(parts)
 
     def _tutor_feedback(self):
         wrong_answers = self._gather_wrong_answers()
         if not wrong_answers:
             prompt = self.prompts.all_correct
-        elif len(wrong_answers) == len(self.questions):
-            detalles = "\n\n".join(f"Pregunta: {self.questions[i].statement}\nRespuesta del estudiante: {ans}\nRespuesta correcta: {self.questions[i].answer}" for i, ans in wrong_answers)
-            prompt = self.prompts.all_wrong.format(n_errors=len(wrong_answers), details=detalles)
         else:
-            detalles = "\n\n".join(f"Pregunta: {self.questions[i].statement}\nRespuesta del estudiante: {ans}\nRespuesta correcta: {self.questions[i].answer}" for i, ans in wrong_answers)
-            prompt = self.prompts.some_wrong.format(n_errors=len(wrong_answers), details=detalles)
-        reply = self._ask_llm(prompt)
-        self._show_feedback(reply)
+            template = self.prompts.all_wrong if len(wrong_answers) == len(self.questions) else self.prompts.some_wrong
+            prompt = template.format(n_errors=len(wrong_answers), details=self._format_details(wrong_answers))
+        self.tutor_btn.config(state="disabled")
+        self._show_feedback("")
+        self._llm_future = self._submit_llm(prompt)
+        self.root.after(50, self._poll_llm, self._llm_future)
+
+    def _submit_llm(self, prompt: str) -> concurrent.futures.Future:
+        fut: concurrent.futures.Future = concurrent.futures.Future()
+
+        def work():
+            try:
+                fut.set_result(self._ask_llm(prompt))
+            except Exception as exc:
+                fut.set_exception(exc)
+
+        threading.Thread(target=work, daemon=True).start()
+        return fut
+
+    def _poll_llm(self, fut: concurrent.futures.Future):
+        self._drain_chunks()
+        if not fut.done():
+            self.root.after(50, self._poll_llm, fut)
+            return
+        self._llm_future = None
+        self._drain_chunks()
+        # El texto final ya viene limpio; reemplaza lo mostrado durante el streaming.
+        self._show_feedback(fut.result())
+        self.tutor_btn.config(state="normal")
 
     def _ask_llm(self, user_prompt: str) -> str:
         if "/no_think" not in user_prompt:
             user_prompt = user_prompt.rstrip() + " /no_think"
-        payload = {"model": self.cfg.model, "messages": [{"role": "system", "content": self.prompts.system}, {"role": "user", "content": user_prompt}], "temperature": self.cfg.temperature, "max_tokens": self.cfg.max_tokens}
+        key = hashlib.sha256(f"{self.cfg.model}|{self.cfg.temperature}|{self.prompts.system}|{user_prompt}".encode()).hexdigest()
+        if key in self._reply_cache:
+            return self._reply_cache[key]
+        payload = self._payload_tpl
+        payload["messages"][1]["content"] = user_prompt
         try:
-            r = requests.post(self.cfg.url, json=payload, timeout=self.cfg.timeout)
-            r.raise_for_status()
-            raw = r.json()["choices"][0]["message"]["content"].strip()
-            return self._strip_hidden_thoughts(raw)
+            buf = io.StringIO()
+            pending, in_think = "", False
+            frames = 0
+            body = []  # líneas fuera de SSE, por si el servidor ignora "stream"
+            with self._session.post(self.cfg.url, json=payload, stream=True, timeout=self.cfg.timeout) as r:
+                r.raise_for_status()
+                # Se trabaja sobre bytes: el parser JSON decodifica el UTF-8 una sola vez.
+                for line in r.iter_lines(decode_unicode=False):
+                    if self._cancel.is_set():
+                        return ""  # ventana cerrada: se corta el stream sin cachear
+                    if not line.startswith(b"data:"):
+                        if not frames:
+                            body.append(line)
+                        continue
+                    frames += 1
+                    data = line[5:].strip()  # el espacio tras "data:" es opcional
+                    if data == b"[DONE]":
+                        break
+                    # Marcos sin contenido (prompt_filter_results, uso de tokens) traen "choices": [].
+                    choices = _json_loads(data).get("choices")
+                    if not choices:
+                        continue
+                    delta = (choices[0].get("delta") or {}).get("content")
+                    if delta:
+                        buf.write(delta)
+                        # Solo se muestra lo que está fuera de <think>…</think>.
+                        visible, pending, in_think = _split_visible(pending + delta, in_think)
+                        if visible:
+                            self._chunks.put(visible)
+            if frames:
+                raw = buf.getvalue().strip()
+            else:
+                # Respuesta JSON normal, sin streaming; sin "choices" queda vacía.
+                choices = _json_loads(b"\n".join(body)).get("choices")
+                raw = ((choices[0].get("message") or {}).get("content") or "").strip() if choices else ""
+            reply = self._strip_hidden_thoughts(raw)
+            if not reply:
+                raise ValueError("el LLM devolvió una respuesta vacía")
+            self._reply_cache[key] = reply
+            return reply
         except Exception as exc:
             return f"Error al consultar LLM: {exc}"
 
+    def _drain_chunks(self):
+        parts = []
+        while True:
+            try:
+                parts.append(self._chunks.get_nowait())
+            except queue.Empty:
+                break
+        if parts:
+            self._append_feedback("".join(parts))
+
+    def _append_feedback(self, text: str):
+        self.feedback.config(state="normal")
+        self.feedback.insert(tk.END, text)
+        self.feedback.see(tk.END)
+        self.feedback.config(state="disabled")
+
     def _show_feedback(self, text: str):
         self.feedback.config(state="normal")
         self.feedback.delete("1.0", tk.END)
@@ -191,15 +418,25 @@ class MathTutorApp:
         self.feedback.config(state="disabled")
 
     def run(self):
-        self.root.mainloop()
+        try:
+            self.root.mainloop()
+        finally:
+            self._cancel.set()
+            # Si hay una consulta en curso, su hilo aún usa la sesión: se deja que
+            # termine con el proceso en vez de cerrarla debajo de él.
+            if self._llm_future is None:
+                self._session.close()
 
 # ───────────── Bootstrap ──────────────
 
 def main():
     try:
-        llm_cfg = LLMConfig.from_file()
-        prompts = PromptTemplates.from_file()
-        title, questions = load_questions()
+        # Las tres lecturas son independientes: se hacen en paralelo.
+        with concurrent.futures.ThreadPoolExecutor(max_workers=3) as ex:
+            fa = ex.submit(LLMConfig.from_file)
+            fb = ex.submit(PromptTemplates.from_file)
+            fc = ex.submit(load_questions)
+            llm_cfg, prompts, (title, questions) = fa.result(), fb.result(), fc.result()
         MathTutorApp(questions, llm_cfg, prompts, title=title, n=2).run()
     except Exception as exc:
         print(f"Error al iniciar la aplicación: {exc}")